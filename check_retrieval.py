@@ -20,6 +20,7 @@ def parse_args():
     parser.add_argument("--docs_folder", default="./data/nersc_doc/docs", type=Path, help="path to the NERSC documentation folder")
     parser.add_argument("--database_folder", default="./data/database", type=Path, help="path to the database saving folder") 
     parser.add_argument("--models_folder",default="../models",type=Path, help="path to the folder containing all the models")
+    parser.add_argument("--use_gpu", action="store_true", help="search a GPU copy of the vector index (when the index type supports it)")
     args = parser.parse_args()
     return args
 
@@ -34,12 +35,14 @@ def main():
     llm = lmntfy.models.llm.Default(models_folder, device='cuda')
     embedder = lmntfy.models.embedding.Default(models_folder, device='cuda')
     reranker = lmntfy.models.reranker.Default(models_folder, device='cuda')
-    database = lmntfy.database.Default(docs_folder, database_folder, llm, embedder, reranker, update_database=False)
+    database = lmntfy.database.Default(docs_folder, database_folder, llm, embedder, reranker, update_database=False, use_gpu=args.use_gpu)
 
-    # runs the retrieval and displays the urls
-    for question in TEST_QUESTIONS:
+    # runs the retrieval on all questions at once
+    chunks_per_question = database.get_closest_chunks_batch(TEST_QUESTIONS, k=8)
+
+    # displays the urls
+    for question, chunks in zip(TEST_QUESTIONS, chunks_per_question):
         print(f"\nQ: {question}")
-        chunks = database.get_closest_chunks(question, k=8)
         for chunk in chunks:
             print(f" * {chunk.url}")
 
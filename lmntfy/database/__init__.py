@@ -1,15 +1,18 @@
 import os
-import json
+import orjson
 import numpy as np
 from tqdm import tqdm
 from pathlib import Path
 from datetime import datetime
-from typing import List, Dict, Set
+from functools import lru_cache
+from typing import List, Dict, Set, Tuple
+from concurrent.futures import ProcessPoolExecutor
 from abc import ABC, abstractmethod
 from ..models import LanguageModel, Embedding, embedding, Reranker, reranker
 from .document_loader import Chunk, chunk_file
 from .document_loader.markdown_spliter import markdown_splitter
-from .utilities.file import File
+from .utilities.file import File, iter_files, hash_file
+from .utilities.embedding_cache import EmbeddingCache, hash_text
 
 def remove_duplicates(chunks:List[Chunk]) -> Chunk:
     """remove duplicates from a list while preserving element order"""
@@ -21,6 +24,32 @@ def remove_duplicates(chunks:List[Chunk]) -> Chunk:
             result.append(item)
     return result
 
+# number of token counts memoized per tokenizer
+# NOTE: documentation files share a lot of boilerplate (headings, paragraphs, lines) that would otherwise be tokenized repeatedly
+TOKEN_COUNT_CACHE_SIZE = 65536
+
+# ----- PARALLEL CHUNKING -----
+# NOTE: those functions are defined at the module level so that they can be run by worker processes
+
+# maximum number of chunking processes (login nodes can have hundreds of cores, shared with other users)
+MAX_CHUNKING_WORKERS = 16
+# minimum number of files per chunking process, below that files are chunked by the main process
+MIN_FILES_PER_CHUNKING_WORKER = 32
+
+# (documentation_folder, token_counter, max_tokens_per_chunk) used by the chunking workers
+_chunking_parameters = None
+
+def _init_chunking_worker(documentation_folder:Path, token_counter, max_tokens_per_chunk:int):
+    """stores the chunking parameters once per worker process"""
+    global _chunking_parameters
+    token_counter = lru_cache(maxsize=TOKEN_COUNT_CACHE_SIZE)(token_counter)
+    _chunking_parameters = (documentation_folder, token_counter, max_tokens_per_chunk)
+
+def _chunk_file_worker(file_path:Path) -> Tuple[str, List[Chunk]]:
+    """hashes a file and slices it into chunks"""
+    documentation_folder, token_counter, max_tokens_per_chunk = _chunking_parameters
+    return hash_file(file_path), chunk_file(file_path, documentation_folder, token_counter, max_tokens_per_chunk)
+
 class Database(ABC):
     """Vector Database"""
     def __init__(self, documentation_folder:Path, database_folder:Path,
@@ -34,14 +63,23 @@ class Database(ABC):
         self.llm = llm
         self.embedder = embedder
         self.reranker = reranker
+        # memoized token counters
+        self._llm_count_tokens = lru_cache(maxsize=TOKEN_COUNT_CACHE_SIZE)(llm.count_tokens)
+        self._embedder_count_tokens = lru_cache(maxsize=TOKEN_COUNT_CACHE_SIZE)(embedder.count_tokens)
         # parameters
         self.min_chunks_per_query = min_chunks_per_query
         # NOTE: we leave space for two additional chunks, representing the prompt and the model's answer
         # dictionary of all files
         self.files: Dict[Path, File] = dict() # file_path -> File
-        # dictionary of all chunk
+        # list of all chunks, indexed by their vector database index
         # NOTE: it might contain identical chunks pointed at by different indices
-        self.chunks: Dict[int, Chunk] = dict() # vector_database_index -> Chunk
+        self.chunks: List[Chunk | None] = list() # vector_database_index -> Chunk (None if the index is free)
+        # indices freed by removed files, reused when adding new chunks
+        self.free_indices: List[int] = list()
+        # hash of the sub-text embedded at each index, used to evict unused embeddings from the cache
+        self.embedding_hashes: Dict[int, str] = dict() # vector_database_index -> hash
+        # cache of the embeddings of the sub-texts currently in the database
+        self.embedding_cache = EmbeddingCache(embedder.embedding_length)
         # set of file and folder names that will not be processed
         self.ignored_files_and_folders: Set[str] = {'timeline'}
         # loads the database from file if possible
@@ -50,10 +88,10 @@ class Database(ABC):
     # ----- VECTOR DATABASE OPERATIONS -----
 
     @abstractmethod
-    def _index_add(self, embedding: np.ndarray) -> int:
+    def _index_add_several(self, embeddings: np.ndarray, indices: List[int]):
         """
-        Abstract method for adding a new vector to the vector database
-        returns its index
+        Abstract method for adding a (nb_vectors, embedding_length) batch of vectors to the vector database
+        at the given indices
         """
         pass
 
@@ -65,41 +103,81 @@ class Database(ABC):
         pass
 
     @abstractmethod
-    def _index_get_closest(self, input_embedding: np.ndarray, k=3) -> List[int]:
+    def _index_get_closest_several(self, input_embeddings: np.ndarray, k=3) -> List[List[int]]:
         """
-        Abstract method, returns the indices of the k closest embeddings in the vector database
+        Abstract method, returns, for each row of the (nb_inputs, embedding_length) input_embeddings,
+        the indices of the (at most) k closest embeddings in the vector database
         """
         pass
 
-    def get_closest_chunks(self, input_text: str, k: int = 3) -> List[Chunk]:
+    def _allocate_indices(self, nb_indices:int) -> List[int]:
         """
-        returns the (at most) k chunks that contains pieces of text closest to the input_text according to its embedding
+        Returns nb_indices free indices, reusing the indices of removed chunks when possible.
+        The corresponding chunks are expected to be filled by the caller.
+        """
+        nb_reused = min(nb_indices, len(self.free_indices))
+        indices = self.free_indices[len(self.free_indices)-nb_reused:]
+        del self.free_indices[len(self.free_indices)-nb_reused:]
+        # grows the chunk list for the remaining indices
+        nb_new = nb_indices - nb_reused
+        indices.extend(range(len(self.chunks), len(self.chunks) + nb_new))
+        self.chunks.extend([None] * nb_new)
+        return indices
+
+    def nb_chunks(self) -> int:
+        """returns the number of chunks currently stored"""
+        return len(self.chunks) - len(self.free_indices)
+
+    def get_closest_chunks_batch(self, input_texts: List[str], k: int = 3) -> List[List[Chunk]]:
+        """
+        returns, for each input text, the (at most) k chunks that contains pieces of text closest to it according to its embedding
+        all input texts are embedded and searched for together
         """
         # we might want to query more chunks than needed then keep the best ones
         use_reranker = not isinstance(self.reranker, reranker.NoReranker)
         nb_chunks_needed = (2*k) if use_reranker else k
         # gets the chunks
-        if len(self.chunks) <= nb_chunks_needed:
+        if self.nb_chunks() <= nb_chunks_needed:
             # we get all the chunks we have
-            chunks = list(self.chunks.values())
+            all_chunks = [chunk for chunk in self.chunks if chunk is not None]
+            chunks_per_text = [list(all_chunks) for _ in input_texts]
         else:
-            # assumes the input is small enough to be embedded
-            input_embedding = self.embedder.embed(input_text, is_query=True)
-            # Loop until we get enough *distinct* chunks
+            # assumes the inputs are small enough to be embedded
+            input_embeddings = self.embedder.embed_batch(input_texts, is_query=True)
+            # Loop until we get enough *distinct* chunks for all inputs
             # (duplicates can stem from embedding the chunk as several subtexts to fit in the embedder context size)
-            chunks = list()
+            chunks_per_text = [list() for _ in input_texts]
+            pending_texts = list(range(len(input_texts)))
             growing_factor = 1
-            while len(chunks) < nb_chunks_needed:
+            while len(pending_texts) > 0:
                 # query the vector database
-                chunks_indices = self._index_get_closest(input_embedding, nb_chunks_needed*growing_factor)
-                # ensures uniqueness
-                chunks = remove_duplicates([self.chunks[i] for i in chunks_indices])
+                nb_chunks_queried = nb_chunks_needed*growing_factor
+                # NOTE: we avoid copying the embeddings when all inputs are still pending (first iteration)
+                pending_embeddings = input_embeddings if (len(pending_texts) == len(input_texts)) else input_embeddings[pending_texts]
+                indices_per_text = self._index_get_closest_several(pending_embeddings, nb_chunks_queried)
+                next_pending_texts = list()
+                for text_index, chunks_indices in zip(pending_texts, indices_per_text):
+                    # ensures uniqueness
+                    chunks_per_text[text_index] = remove_duplicates([self.chunks[i] for i in chunks_indices])
+                    # tries again if we do not have enough chunks and the vector database can return more
+                    # (approximate indexes only search some of their vectors)
+                    if (len(chunks_per_text[text_index]) < nb_chunks_needed) and (len(chunks_indices) == nb_chunks_queried):
+                        next_pending_texts.append(text_index)
+                pending_texts = next_pending_texts
                 # the next call will request twice as many items
                 growing_factor *= 2
-        # reranks the chunks
-        chunks = self.reranker.rerank(input_text, chunks) if use_reranker else chunks
-        # keep only the required number of chunks
-        return chunks[:k] if (len(chunks) > k) else chunks
+        # reranks the chunks and keep only the required number of chunks
+        result = list()
+        for input_text, chunks in zip(input_texts, chunks_per_text):
+            chunks = self.reranker.rerank(input_text, chunks) if use_reranker else chunks
+            result.append(chunks[:k])
+        return result
+
+    def get_closest_chunks(self, input_text: str, k: int = 3) -> List[Chunk]:
+        """
+        returns the (at most) k chunks that contains pieces of text closest to the input_text according to its embedding
+        """
+        return self.get_closest_chunks_batch([input_text], k)[0]
 
     # ----- FILE OPERATIONS -----
 
@@ -108,59 +186,144 @@ class Database(ABC):
         return file_path.name in self.ignored_files_and_folders or \
                any(parent.name in self.ignored_files_and_folders for parent in file_path.parents)
 
-    def remove_file(self, file_path:Path):
-        """Removes a file's content from the Database"""
-        file = self.files[file_path]
-        indices_to_remove = file.vector_database_indices
-        # remove file chunks from chunks
+    def _embed_passages(self, texts:List[str], hashes:List[str]) -> np.ndarray:
+        """
+        Embeds a list of texts (with the given hashes) into a (nb_texts, embedding_length) matrix
+        reusing cached embeddings when possible and caching the new ones
+        """
+        embeddings = np.empty((len(texts), self.embedder.embedding_length), dtype=np.float32)
+        # gets the embeddings we already know
+        missing_indices = list()
+        for i, hash in enumerate(hashes):
+            cached_embedding = self.embedding_cache.get(hash)
+            if cached_embedding is None:
+                missing_indices.append(i)
+            else:
+                embeddings[i] = cached_embedding
+        # computes the other ones in a single batch
+        if len(missing_indices) > 0:
+            new_embeddings = self.embedder.embed_batch([texts[i] for i in missing_indices])
+            embeddings[missing_indices] = new_embeddings
+            self.embedding_cache.put_many([hashes[i] for i in missing_indices], new_embeddings)
+        return embeddings
+
+    def remove_files(self, file_paths:List[Path]):
+        """Removes several files' content from the Database, using a single call to the vector database"""
+        indices_to_remove = list()
+        for file_path in file_paths:
+            indices_to_remove.extend(self.files[file_path].vector_database_indices)
+            # remove file from files
+            del self.files[file_path]
+        # remove file chunks from chunks, freeing their indices
         for index in indices_to_remove:
-            del self.chunks[index]
+            self.chunks[index] = None
+            self.embedding_hashes.pop(index, None)
+        self.free_indices.extend(indices_to_remove)
         # remove embeddings from vector database
-        self._index_remove_several(indices_to_remove)
-        # remove file from files
-        del self.files[file_path]
+        if len(indices_to_remove) > 0:
+            self._index_remove_several(indices_to_remove)
 
-    def add_file(self, file_path:Path):
-        """Add a file's content to the database"""
-        # shortcut the function on ignored files
-        if self._is_ignored_file(file_path): return
+    def remove_file(self, file_path:Path):
+        """Removes a file's content from the Database"""
+        self.remove_files([file_path])
+
+    def _max_tokens_per_chunk(self) -> float:
+        """number of tokens per chunk, small enough to fit several chunks in the model's context size"""
+        return self.llm.context_size / (self.min_chunks_per_query + 2)
+
+    def _add_chunks(self, file_path:Path, file_update_date:datetime, content_hash:str, chunks:List[Chunk]):
+        """Add a file's chunks to the database"""
         # open file in the database
-        file_update_date = datetime.fromtimestamp(file_path.stat().st_mtime)
-        file = File(creation_date=file_update_date)
-        # slice file into chunks small enough to fit several in the model's context size
-        max_tokens_per_chunk = self.llm.context_size / (self.min_chunks_per_query + 2)
-        chunks = chunk_file(file_path, self.documentation_folder, self.llm.count_tokens, max_tokens_per_chunk)
+        file = File(creation_date=file_update_date, content_hash=content_hash)
+        # slice chunks into sub chunks small enough to be embedded
+        sub_texts = list()
+        sub_texts_chunks = list()
         for chunk in chunks:
-            # slice chunk into sub chunks small enough to be embedded
-            sub_chunks = markdown_splitter(chunk.url, chunk.content, self.embedder.count_tokens, self.embedder.context_size)
+            sub_chunks = markdown_splitter(chunk.url, chunk.content, self._embedder_count_tokens, self.embedder.context_size)
             for sub_chunk in sub_chunks:
-                # compute the embedding of the sub-chunk
-                embedding = self.embedder.embed(sub_chunk.content)
-                # add embedding to the vector database
-                sub_text_index = self._index_add(embedding)
+                sub_texts.append(sub_chunk.content)
+                sub_texts_chunks.append(chunk)
+        # NOTE: we have embeddings pointing at parts of the full chunk
+        # averaging them to get a chunk's embedding also somewhat works
+        if len(sub_texts) > 0:
+            # compute the embeddings of all sub-chunks in a single batch
+            sub_texts_hashes = [hash_text(sub_text) for sub_text in sub_texts]
+            embeddings = self._embed_passages(sub_texts, sub_texts_hashes)
+            # add embeddings to the vector database
+            sub_texts_indices = self._allocate_indices(len(sub_texts))
+            self._index_add_several(embeddings, sub_texts_indices)
+            for sub_text_index, chunk, sub_text_hash in zip(sub_texts_indices, sub_texts_chunks, sub_texts_hashes):
                 # add index to file
                 file.add_index(sub_text_index)
                 # register chunk at the sub chunk's index
                 self.chunks[sub_text_index] = chunk
-            # NOTE: we have embeddings pointing at parts of the full chunk
-            # averaging them to get a chunk's embedding also somewhat works
+                self.embedding_hashes[sub_text_index] = sub_text_hash
         # add file to files
         self.files[file_path] = file
 
+    def add_file(self, file_path:Path):
+        """Add a file's content to the database"""
+        # shortcut the function on ignored files
+        if self._is_ignored_file(file_path): return
+        # slice file into chunks small enough to fit several in the model's context size
+        file_update_date = datetime.fromtimestamp(file_path.stat().st_mtime)
+        content_hash = hash_file(file_path)
+        chunks = chunk_file(file_path, self.documentation_folder, self._llm_count_tokens, self._max_tokens_per_chunk())
+        # add them to the database
+        self._add_chunks(file_path, file_update_date, content_hash, chunks)
+
+    def add_files(self, files:List[Tuple[Path, datetime]], verbose=False):
+        """
+        Add several files' content to the database, given their paths and update dates.
+        When there are enough files, they are sliced into chunks in parallel, by worker processes, while the main process embeds and stores their chunks.
+        """
+        # shortcut the function on ignored files
+        files = [(file_path, file_update_date) for (file_path, file_update_date) in files if not self._is_ignored_file(file_path)]
+        if len(files) == 0: return
+        file_paths = [file_path for (file_path, file_update_date) in files]
+        nb_workers = min(MAX_CHUNKING_WORKERS, os.cpu_count() or 1, len(file_paths) // MIN_FILES_PER_CHUNKING_WORKER)
+        if nb_workers <= 1:
+            # not worth starting processes, chunks the files in the main process
+            for file_path, file_update_date in tqdm(files, disable=not verbose, desc="Loading new files"):
+                content_hash = hash_file(file_path)
+                chunks = chunk_file(file_path, self.documentation_folder, self._llm_count_tokens, self._max_tokens_per_chunk())
+                self._add_chunks(file_path, file_update_date, content_hash, chunks)
+            return
+        # NOTE: we pass the tokenizer's counter rather than the llm's as the tokenizer is cheap to send to other processes
+        worker_parameters = (self.documentation_folder, self.llm.tokenizer.count_tokens, self._max_tokens_per_chunk())
+        with ProcessPoolExecutor(max_workers=nb_workers, initializer=_init_chunking_worker, initargs=worker_parameters) as executor:
+            chunked_files = zip(files, executor.map(_chunk_file_worker, file_paths, chunksize=8))
+            for (file_path, file_update_date), (content_hash, chunks) in tqdm(chunked_files, total=len(files), disable=not verbose, desc="Loading new files"):
+                self._add_chunks(file_path, file_update_date, content_hash, chunks)
+
     def update(self, verbose=False):
         """Goes over the documentation and insures that we are up to date then saves the result."""
-        # removes files that do not exist anymore or are out of date
-        existing_files = list(self.files.items())
-        for file_path, file in tqdm(existing_files, disable=not verbose, desc="Removing old files"):
-            if (not file_path.exists()) or (datetime.fromtimestamp(file_path.stat().st_mtime) > file.creation_date):
-                self.remove_file(file_path)
-        # add new files
-        current_files = [Path(root) / file for root, dirs, files in os.walk(self.documentation_folder) for file in files]
+        # goes over the documentation once, sorting files into new, out of date, and removed files
+        files_to_add = list()
+        files_to_remove = list()
+        current_files = set()
+        for file_path, file_update_date in iter_files(self.documentation_folder):
+            current_files.add(file_path)
+            file = self.files.get(file_path)
+            if file is None:
+                # new file
+                files_to_add.append((file_path, file_update_date))
+            elif file_update_date > file.creation_date:
+                if (file.content_hash is not None) and (hash_file(file_path) == file.content_hash):
+                    # touched but unchanged file (git checkout, rsync, etc), no need to process it again
+                    file.creation_date = file_update_date
+                else:
+                    # out of date file
+                    files_to_remove.append(file_path)
+                    files_to_add.append((file_path, file_update_date))
         if len(current_files) == 0:
             raise RuntimeError(f"ERROR: the documentation folder '{self.documentation_folder}' is empty or does not exist.")
-        for file_path in tqdm(current_files, disable=not verbose, desc="Loading new files"):
-            if not file_path in self.files:
-                self.add_file(file_path)
+        # files that do not exist anymore
+        files_to_remove.extend(file_path for file_path in self.files if file_path not in current_files)
+        # removes files that do not exist anymore or are out of date
+        self.remove_files(files_to_remove)
+        # add new files
+        self.add_files(files_to_add, verbose=verbose)
         # save resulting database
         self.save()
 
@@ -173,13 +336,27 @@ class Database(ABC):
     def load(self, update_database=True, verbose=False):
         if self.exists():
             # load the files info
-            with open(self.database_folder / 'files.json', 'r') as f:
-                files_dict = json.load(f)
+            with open(self.database_folder / 'files.json', 'rb') as f:
+                files_dict = orjson.loads(f.read())
                 self.files = {Path(k): File.from_dict(v) for k, v in files_dict.items()}
             # load the chunks
-            with open(self.database_folder / 'chunks.json', 'r') as f:
-                chunks_dict = json.load(f)
-                self.chunks = {int(k): Chunk.from_dict(v) for k, v in chunks_dict.items()}
+            with open(self.database_folder / 'chunks.json', 'rb') as f:
+                chunks_data = orjson.loads(f.read())
+                if 'rows' in chunks_data:
+                    # distinct chunks, then the chunk pointed at by each index
+                    unique_chunks = [Chunk(url, content) for (url, content) in chunks_data['chunks']]
+                    self.chunks = [(None if (row is None) else unique_chunks[row]) for row in chunks_data['rows']]
+                    hashes = chunks_data.get('hashes', list())
+                    self.embedding_hashes = {index: hash for (index, hash) in enumerate(hashes) if hash is not None}
+                else:
+                    # older format, a dictionary from (stringified) index to chunk
+                    legacy_chunks = {int(index): Chunk.from_dict(chunk) for (index, chunk) in chunks_data.items()}
+                    self.chunks = [None] * (max(legacy_chunks.keys(), default=-1) + 1)
+                    for index, chunk in legacy_chunks.items():
+                        self.chunks[index] = chunk
+                self.free_indices = [index for (index, chunk) in enumerate(self.chunks) if chunk is None]
+            # load the embedding cache
+            self.embedding_cache.load(self.database_folder)
         elif verbose:
             print(f"Warning: '{self.database_folder}' or its content does not currently exist. The database will be created from scratch.")
         # updates the database to the latest documentation
@@ -190,13 +367,31 @@ class Database(ABC):
         # insures that the saving folder exists
         self.database_folder.mkdir(parents=True, exist_ok=True)
         # saves the files info
-        with open(self.database_folder / 'files.json', 'w') as f:
+        with open(self.database_folder / 'files.json', 'wb') as f:
             files_dict = {str(k): v.to_dict() for k, v in self.files.items()}
-            json.dump(files_dict, f)
+            f.write(orjson.dumps(files_dict))
         # saves the chunks
-        with open(self.database_folder / 'chunks.json', 'w') as f:
-            chunks_dict = {k: v.to_dict() for k, v in self.chunks.items()}
-            json.dump(chunks_dict, f)
+        # NOTE: chunks pointed at by several indices (one per embedded sub-text) are stored only once
+        with open(self.database_folder / 'chunks.json', 'wb') as f:
+            chunk_rows = dict() # id(chunk) -> row in unique_chunks
+            unique_chunks = list()
+            rows = list()
+            for chunk in self.chunks:
+                if chunk is None:
+                    rows.append(None)
+                else:
+                    row = chunk_rows.get(id(chunk))
+                    if row is None:
+                        row = chunk_rows[id(chunk)] = len(unique_chunks)
+                        unique_chunks.append([chunk.url, chunk.content])
+                    rows.append(row)
+            hashes = [self.embedding_hashes.get(index) for index in range(len(self.chunks))]
+            f.write(orjson.dumps({'chunks': unique_chunks, 'rows': rows, 'hashes': hashes}))
+        # saves the embedding cache, evicting embeddings that are not used anymore
+        # NOTE: we do not evict if some of our embeddings are of unknown origin (databases saved by older versions)
+        all_hashes_known = all((index in self.embedding_hashes) for (index, chunk) in enumerate(self.chunks) if chunk is not None)
+        kept_hashes = set(self.embedding_hashes.values()) if all_hashes_known else None
+        self.embedding_cache.save(self.database_folder, kept_hashes)
 
 from .faiss import FaissDatabase
 from .whoosh import WhooshDatabase
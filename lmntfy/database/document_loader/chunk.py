@@ -1,20 +1,25 @@
 from pathlib import Path
+from functools import lru_cache
 from urllib.parse import quote
 import re
 
+# matches a '.md' extension, preceded by an optional '/index', at the end of a path element
+# NOTE: the path element can be followed by an anchor or a query ('slurm.md#sbatch')
+MARKDOWN_EXTENSION_PATTERN = re.compile(r'(?:/index)?\.md(?=[/#?]|$)')
+
+@lru_cache(maxsize=None)
 def path2url(file_path:Path, documentation_folder_path:Path):
     """
     takes a file path and the documentation folder containing the file
     outputs the corresponding url
+    NOTE: memoized as it is called on every link of every file
     """
     # remove the documentation folder from the path
     relative_path = file_path.relative_to(documentation_folder_path)
     # Construct the new URL
     url = "https://docs.nersc.gov/" + str(relative_path)
-    # Replace an optional '/index.md' with '/'
-    url = url.replace("/index.md", "/")
-    # Replace the final '.md' with '/'
-    url = url.replace(".md", "/")
+    # Replace the final '.md' (or '/index.md') with '/'
+    url = MARKDOWN_EXTENSION_PATTERN.sub('/', url)
     # Convert spaces into URL valid format
     url = quote(url, safe='/:#')
     return url
@@ -1,4 +1,3 @@
-import re
 from .text_spliter import text_splitter
 from .chunk import Chunk, header2url
 from typing import Callable, List
@@ -22,9 +21,9 @@ class Markdown:
             if line.startswith("```"):
                 in_code_block = not in_code_block
             # inserts either text or a heading
-            match = re.match(r'^#+', line)
-            if match and not in_code_block:
-                level = len(match.group())
+            # NOTE: the cheap `startswith` test filters out most lines before any further processing
+            if line.startswith('#') and not in_code_block:
+                level = len(line) - len(line.lstrip('#'))
                 result.insert_heading(text=line, level=level)
             else:
                 result.insert_text(line)
@@ -1,42 +1,125 @@
 import faiss
-import json
+import orjson
 import numpy as np
 from pathlib import Path
 from typing import List
 from . import Database
 from ..models import LanguageModel, Embedding, Reranker
 
+# faiss factory descriptions of the index to use, as a function of the minimum number of vectors stored
+# NOTE: indexes are trained on all vectors stored when we switch to them
+INDEX_DESCRIPTIONS = [
+    (0, "SQfp16"), # exhaustive search on half precision vectors, (nearly) lossless on normalized embeddings but half the memory
+    (1_000, "SQ8"), # exhaustive search on 8 bits quantized vectors, 4x less memory to go through
+    (10_000, "IVF256,SQ8"), # inverted file index with 8 bits scalar quantization, sub-linear search time
+]
+
+def build_index(embedding_length:int, description:str) -> faiss.Index:
+    """
+    Builds an (untrained) index supporting addition and deletion by id
+    from its faiss factory description.
+    """
+    raw_index = faiss.index_factory(embedding_length, description, faiss.METRIC_INNER_PRODUCT)
+    ivf_index = faiss.try_extract_index_ivf(raw_index)
+    if ivf_index is None:
+        # index on top of the database to support addition and deletion by id
+        return faiss.IndexIDMap2(raw_index)
+    else:
+        # inverted file indexes support ids natively
+        # NOTE: IndexIDMap assumes that the underlying index compacts itself on removal, which IVF indexes do not do
+        # the hashtable lets us remove ids without scanning all inverted lists
+        ivf_index.set_direct_map_type(faiss.DirectMap.Hashtable)
+        return raw_index
+
 class FaissDatabase(Database):
     def __init__(self, documentation_folder:Path, database_folder:Path,
                        llm: LanguageModel, embedder: Embedding, reranker: Reranker,
-                       min_chunks_per_query=8, update_database=True, name:str='faiss'):
+                       min_chunks_per_query=8, update_database=True, name:str='faiss',
+                       index_descriptions=INDEX_DESCRIPTIONS, nprobe=8, use_gpu=False):
+        # parameters of the index
+        self.index_descriptions = index_descriptions # (minimum number of vectors, index description), sorted by size
+        self.nprobe = nprobe # number of inverted lists visited per query
         # vector database that will be used to store the vectors
-        raw_index = faiss.IndexFlatIP(embedder.embedding_length)
-        # index on top of the database to support addition and deletion by id
-        self.index = faiss.IndexIDMap(raw_index)
-        self.current_id = 0
+        self.index_description = self.index_descriptions[0][1]
+        self.index = build_index(embedder.embedding_length, self.index_description)
+        # optional GPU copy of the index, used for searches
+        # NOTE: the CPU index stays the reference, it is the one modified and saved
+        self.use_gpu = use_gpu and (faiss.get_num_gpus() > 0)
+        self.gpu_resources = faiss.StandardGpuResources() if self.use_gpu else None
+        self.gpu_index = None
+        self.gpu_copy_failed = False # set when the current index cannot be moved to GPU
         # concludes the initialisation and loads
         super().__init__(documentation_folder, database_folder, llm, embedder, reranker, min_chunks_per_query, update_database, name)
 
-    def _index_add(self, embedding: np.ndarray) -> int:
-        assert (embedding.size == self.embedder.embedding_length), f"Invalid shape for embedding ({embedding.size} instead of {self.embedder.embedding_length})"
-        # create a single element batch with the embeddings and indices
-        embedding_batch = embedding.reshape((1,-1))
-        id_batch = np.array([self.current_id], dtype=np.int64)
-        # adds them to the vector database
-        self.index.add_with_ids(embedding_batch, id_batch)
-        # update our global index
-        self.current_id += 1
-        return self.current_id - 1  # Return the ID of the added vector
+    def _index_add_several(self, embeddings: np.ndarray, indices: List[int]):
+        assert (embeddings.ndim == 2) and (embeddings.shape[1] == self.embedder.embedding_length), f"Invalid shape for embeddings ({embeddings.shape} instead of (N,{self.embedder.embedding_length}))"
+        assert (embeddings.shape[0] == len(indices)), f"Expected one index per embedding ({len(indices)} indices for {embeddings.shape[0]} embeddings)"
+        # adds them to the vector database in a single call
+        id_batch = np.array(indices, dtype=np.int64)
+        self.index.add_with_ids(np.ascontiguousarray(embeddings, dtype=np.float32), id_batch)
+        self.gpu_index = None # outdated
+        # switches to a larger index if we now have enough vectors
+        self._maybe_train()
+
+    def _maybe_train(self):
+        """
+        Once we have enough vectors for the next index in self.index_descriptions,
+        trains it on them and migrates all vectors into it.
+        """
+        # finds the largest index we have enough vectors for
+        descriptions = [description for (min_size, description) in self.index_descriptions]
+        target_description = [description for (min_size, description) in self.index_descriptions if self.index.ntotal >= min_size][-1]
+        # we only ever move up, from an index supporting vector extraction
+        is_larger = (self.index_description not in descriptions) or (descriptions.index(target_description) > descriptions.index(self.index_description))
+        if (not is_larger) or (not hasattr(self.index, 'id_map')): return
+        # extracts the vectors and their ids from the current index
+        ids = faiss.vector_to_array(self.index.id_map)
+        embeddings = self.index.index.reconstruct_n(0, self.index.ntotal)
+        # trains the new index and moves the vectors into it
+        index = build_index(self.embedder.embedding_length, target_description)
+        index.train(embeddings)
+        index.add_with_ids(embeddings, ids)
+        self.index = index
+        self.index_description = target_description
+        self._set_search_parameters()
+        # the new index might be movable to GPU where the previous one was not
+        self.gpu_index = None
+        self.gpu_copy_failed = False
+
+    def _set_search_parameters(self):
+        """sets the number of inverted lists visited per query, if the index has some"""
+        ivf_index = faiss.try_extract_index_ivf(self.index)
+        if ivf_index is not None:
+            ivf_index.nprobe = self.nprobe
 
     def _index_remove_several(self, indices: List[int]):
         self.index.remove_ids(np.array(indices, dtype=np.int64))
+        self.gpu_index = None # outdated
+
+    def _search_index(self) -> faiss.Index:
+        """
+        Returns the index that should be used for searches:
+        a GPU copy of the index if we use a GPU, the index itself otherwise.
+        NOTE: not all index types can be moved to GPU (in practice, only the IVF tier),
+              other tiers are searched on CPU until `_maybe_train` switches to a new index
+        """
+        if (not self.use_gpu) or self.gpu_copy_failed:
+            return self.index
+        if self.gpu_index is None:
+            try:
+                self.gpu_index = faiss.index_cpu_to_gpu(self.gpu_resources, 0, self.index)
+            except RuntimeError as e:
+                # not all index types can be moved to GPU
+                print(f"Warning: could not move the '{self.index_description}' index to GPU ({e}), searching on CPU instead.")
+                self.gpu_copy_failed = True
+                return self.index
+        return self.gpu_index
 
-    def _index_get_closest(self, input_embedding: np.ndarray, k=3) -> List[int]:
-        assert (input_embedding.size == self.embedder.embedding_length), "Invalid shape for input_embedding"
-        input_embedding_batch = input_embedding.reshape((1,-1))
-        distances, indices = self.index.search(input_embedding_batch, k)
-        return indices.flatten().tolist()
+    def _index_get_closest_several(self, input_embeddings: np.ndarray, k=3) -> List[List[int]]:
+        assert (input_embeddings.ndim == 2) and (input_embeddings.shape[1] == self.embedder.embedding_length), "Invalid shape for input_embeddings"
+        distances, indices = self._search_index().search(np.ascontiguousarray(input_embeddings, dtype=np.float32), k)
+        # NOTE: faiss returns -1 when it does not find enough vectors
+        return [[index for index in row if index >= 0] for row in indices.tolist()]
 
     def exists(self) -> bool:
         """returns True if the database already exists on disk"""
@@ -51,18 +134,25 @@ class FaissDatabase(Database):
         index_path = self.database_folder / 'index.faiss'
         faiss.write_index(self.index, str(index_path))
         # saves the database data
-        with open(self.database_folder / 'faiss_vector_database.json', 'w') as f:
-            database_data = {'current_id': self.current_id}
-            json.dump(database_data, f)
+        with open(self.database_folder / 'faiss_vector_database.json', 'wb') as f:
+            database_data = {'index_description': self.index_description}
+            f.write(orjson.dumps(database_data))
 
     def load(self, update_database=True, verbose=False):
         if self.exists():
             # load the index
+            # NOTE: when the database will not be modified, we open the index read-only with memory-mapping
+            # faiss only memory-maps the inverted lists of IVF indexes (such that the OS only pages in the lists we search),
+            # smaller (flat or scalar quantized) indexes are still read fully
             index_path = self.database_folder / 'index.faiss'
-            self.index = faiss.read_index(str(index_path))
+            io_flags = 0 if update_database else (faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            self.index = faiss.read_index(str(index_path), io_flags)
+            self.gpu_index = None
+            self.gpu_copy_failed = False
             # load the database_data
-            with open(self.database_folder / 'faiss_vector_database.json', 'r') as f:
-                database_data = json.load(f)
-                self.current_id = int(database_data['current_id'])
+            with open(self.database_folder / 'faiss_vector_database.json', 'rb') as f:
+                database_data = orjson.loads(f.read())
+                self.index_description = database_data.get('index_description', "Flat") # older databases used a "Flat" index
+            self._set_search_parameters()
         # loads the rest of the database and optionaly updates it
         super().load(update_database=update_database, verbose=verbose)
\ No newline at end of file
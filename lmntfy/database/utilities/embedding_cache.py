@@ -0,0 +1,91 @@
+import os
+import orjson
+import hashlib
+import numpy as np
+from pathlib import Path
+from typing import List, Dict, Set
+
+# embeddings are stored in half precision, halving the size of the cache
+# NOTE: this is (nearly) lossless for normalized embeddings
+CACHE_DTYPE = np.float16
+
+def hash_text(text:str) -> str:
+    """returns a hash of the text, used as a key in the embedding cache"""
+    return hashlib.sha256(text.encode('utf8')).hexdigest()
+
+class EmbeddingCache:
+    """
+    Persistent cache of embeddings, indexed by the hash of the embedded text.
+    Lets us avoid recomputing embeddings for text we have already seen (unchanged files, boilerplate sections, etc).
+
+    On disk, the embeddings are stored as a single `.npy` matrix (memory-mapped on load)
+    and the hashes as a json dictionary (hash -> row in the matrix).
+    """
+    def __init__(self, embedding_length:int):
+        self.embedding_length = embedding_length
+        # hash -> row in the embeddings
+        self.rows: Dict[str, int] = dict()
+        # embeddings stored on disk
+        self.embeddings = np.empty((0, embedding_length), dtype=CACHE_DTYPE)
+        # embeddings added since the last save
+        self.new_embeddings: List[np.ndarray] = list()
+        self.nb_embeddings = 0
+
+    def get(self, hash:str) -> np.ndarray | None:
+        """returns the embedding associated with the hash, None if it is not in the cache"""
+        row = self.rows.get(hash)
+        if row is None:
+            return None
+        elif row < self.embeddings.shape[0]:
+            return self.embeddings[row]
+        else:
+            return self.new_embeddings[row - self.embeddings.shape[0]]
+
+    def put_many(self, hashes:List[str], embeddings:np.ndarray):
+        """adds a (nb_hashes, embedding_length) batch of embeddings to the cache"""
+        for hash, embedding in zip(hashes, embeddings):
+            if hash not in self.rows:
+                self.rows[hash] = self.nb_embeddings
+                self.new_embeddings.append(np.array(embedding, dtype=CACHE_DTYPE))
+                self.nb_embeddings += 1
+
+    def exists(self, folder:Path) -> bool:
+        """returns True if the cache already exists on disk"""
+        return (folder / 'embedding_cache.npy').exists() and (folder / 'embedding_cache.json').exists()
+
+    def save(self, folder:Path, kept_hashes:Set[str]=None):
+        """
+        saves the cache, assumes the folder exists
+        if kept_hashes is given, embeddings whose hash is not in it are evicted from the cache
+        """
+        # nothing to do if the cache did not change
+        has_evictions = (kept_hashes is not None) and any((hash not in kept_hashes) for hash in self.rows)
+        if (len(self.new_embeddings) == 0) and (not has_evictions): return
+        # merges new embeddings into the stored ones
+        embeddings = self.embeddings
+        if len(self.new_embeddings) > 0:
+            embeddings = np.concatenate([embeddings, np.stack(self.new_embeddings)])
+        # keeps only the embeddings that are still in use
+        if has_evictions:
+            kept_rows = [(hash, row) for (hash, row) in self.rows.items() if hash in kept_hashes]
+            embeddings = embeddings[np.array([row for (hash, row) in kept_rows], dtype=np.int64)]
+            self.rows = {hash: new_row for (new_row, (hash, row)) in enumerate(kept_rows)}
+        # NOTE: the cast converts caches saved by older versions
+        self.embeddings = embeddings.astype(CACHE_DTYPE, copy=False)
+        self.new_embeddings = list()
+        self.nb_embeddings = self.embeddings.shape[0]
+        # NOTE: we write to a temporary file then move it, as the previous file might be memory-mapped
+        tmp_path = folder / 'embedding_cache.tmp.npy'
+        np.save(tmp_path, self.embeddings)
+        os.replace(tmp_path, folder / 'embedding_cache.npy')
+        with open(folder / 'embedding_cache.json', 'wb') as f:
+            f.write(orjson.dumps(self.rows))
+
+    def load(self, folder:Path):
+        """loads the cache if it exists"""
+        if self.exists(folder):
+            self.embeddings = np.load(folder / 'embedding_cache.npy', mmap_mode='r')
+            with open(folder / 'embedding_cache.json', 'rb') as f:
+                self.rows = orjson.loads(f.read())
+            self.new_embeddings = list()
+            self.nb_embeddings = self.embeddings.shape[0]
@@ -1,11 +1,17 @@
+import os
+import hashlib
+from pathlib import Path
 from datetime import datetime
+from typing import Iterator, Tuple
 
 class File:
-    def __init__(self, creation_date, vector_database_indices=None):
+    def __init__(self, creation_date, vector_database_indices=None, content_hash=None):
         # when was the file last modified
         self.creation_date = creation_date
         # list of all database indices
         self.vector_database_indices = vector_database_indices or list()
+        # hash of the file's content, None if unknown
+        self.content_hash = content_hash
 
     def add_index(self, vector_database_index):
         self.vector_database_indices.append(vector_database_index)
@@ -13,11 +19,38 @@ class File:
     def to_dict(self):
         return {
             'creation_date': self.creation_date.isoformat(),
-            'vector_database_indices': self.vector_database_indices
+            'vector_database_indices': self.vector_database_indices,
+            'content_hash': self.content_hash
         }
 
     @staticmethod
     def from_dict(data):
         creation_date = datetime.fromisoformat(data['creation_date'])
         vector_database_indices = data['vector_database_indices']
-        return File(creation_date, vector_database_indices)
\ No newline at end of file
+        content_hash = data.get('content_hash') # missing in older databases
+        return File(creation_date, vector_database_indices, content_hash)
+
+def hash_file(file_path:Path) -> str:
+    """
+    returns a hash of the file's content
+    used to detect files whose modification date changed but not their content
+    """
+    return hashlib.blake2b(file_path.read_bytes(), digest_size=32).hexdigest()
+
+def iter_files(folder:Path) -> Iterator[Tuple[Path, datetime]]:
+    """
+    Recursively goes over all files in a folder, yielding their path and last modification date.
+    Uses `os.scandir` to get both in a single pass over the folder.
+    NOTE: symlinks to folders are not followed (same as `os.walk`)
+    """
+    try:
+        entries = os.scandir(folder)
+    except OSError:
+        # unreadable or missing folder (also ignored by `os.walk`)
+        return
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_files(Path(entry.path))
+            elif not entry.is_dir():
+                yield Path(entry.path), datetime.fromtimestamp(entry.stat().st_mtime)
@@ -1,27 +1,36 @@
-import json
+import re
+import os
+from functools import lru_cache
 from pathlib import Path
-from typing import List
-from .document_loader import Chunk, chunk_file
-from . import Database
+from typing import List, Tuple
+from .document_loader import Chunk
+from . import Database, MAX_CHUNKING_WORKERS
 from ..models import LanguageModel, Embedding, Reranker
 from .utilities.file import File
 from datetime import datetime
 
-from whoosh.index import exists_in, create_in, open_dir
+from whoosh.index import exists_in, create_in, open_dir, FileIndex
 from whoosh.fields import Schema, ID, STORED, TEXT, KEYWORD
 from whoosh.qparser import MultifieldParser, OrGroup
 from whoosh.analysis import StemmingAnalyzer
 from whoosh import scoring
 
+# single analyzer shared by all fields
+STEMMING_ANALYZER = StemmingAnalyzer()
+
 # Define the schema for our Chunk index
 # somewhat inspired by this: https://git.charlesreid1.com/charlesreid1/markdown-search
 CHUNK_SCHEMA = Schema(
     filepath=ID(stored=True), # will be used to delete old chunks
     url=STORED(), # useful to rebuild chunks, not used for search
-    headlines=KEYWORD(analyzer=StemmingAnalyzer(), field_boost=5.0), # markdown titles, more important
-    content=TEXT(stored=True, phrase=False, analyzer=StemmingAnalyzer(), field_boost=1.0) # actual text
+    headlines=KEYWORD(analyzer=STEMMING_ANALYZER, field_boost=5.0), # markdown titles, more important
+    content=TEXT(stored=True, phrase=False, analyzer=STEMMING_ANALYZER, field_boost=1.0) # actual text
 )
 
+# matches lines starting with a '#'
+# NOTE: a single regex scan avoids building a string for every line of the content
+HEADLINE_PATTERN = re.compile(r'^#.*$', re.MULTILINE)
+
 def extract_markdown_headlines(content: str) -> str:
     """
     Produces a string that only contains the headlines of a markdown file.
@@ -34,10 +43,28 @@ def extract_markdown_headlines(content: str) -> str:
       each followed by a newline character.
     """
     # keep only the headline lines
-    headlines = [line.strip() for line in content.split('\n') if line.startswith('#')]
+    headlines = [line.strip() for line in HEADLINE_PATTERN.findall(content)]
     # Join the headlines with newline characters and return
     return '\n'.join(headlines)
 
+@lru_cache(maxsize=8)
+def _open_index(folder:str) -> FileIndex:
+    """
+    Opens the index stored in the folder, creating it if needed.
+    The index is cached per folder as opening it reads all segments metadata (slow on shared filesystems),
+    call `_open_index.cache_clear()` to force a re-open.
+    NOTE: searchers and writers created from the index always see its latest commit
+    """
+    if exists_in(folder):
+        return open_dir(folder)
+    else:
+        return create_in(folder, CHUNK_SCHEMA)
+
+# minimum number of files added at once (such as a full rebuild) for which we use a multiprocess writer
+MULTIPROCESS_WRITER_MIN_FILES = 256
+# number of segments above which the index is optimized (merged into a single segment) on save
+MAX_SEGMENTS_BEFORE_OPTIMIZE = 8
+
 class WhooshDatabase(Database):
     """
     Traditional search algorithm instead of a vector database.
@@ -48,14 +75,16 @@ class WhooshDatabase(Database):
                        min_chunks_per_query=8, update_database=True, name:str='whoosh'):
         # whoosh database that will be used to store the chunks
         self.index = None
-        self.current_id = 0
+        # writer shared by all files while adding several files
+        self.writer = None
+        # set when files were added since the last save, the index might then need to be optimized
+        self.has_new_segments = False
         # concludes the initialisation
         super().__init__(documentation_folder, database_folder, llm, embedder, reranker, min_chunks_per_query, update_database, name)
 
-    def _index_add(self, embedding) -> int:
+    def _index_add_several(self, embeddings, indices: List[int]):
         """
-        Abstract method for adding a new vector to the vector database
-        returns its index
+        Abstract method for adding a batch of vectors to the vector database at the given indices
         """
         raise RuntimeError("This method should never be called.")
 
@@ -65,17 +94,23 @@ class WhooshDatabase(Database):
         """
         raise RuntimeError("This method should never be called.")
 
-    def _index_get_closest(self, input_embedding, k=3) -> List[int]:
+    def _index_get_closest_several(self, input_embeddings, k=3) -> List[List[int]]:
         """
-        Abstract method, returns the indices of the k closest embeddings in the vector database
+        Abstract method, returns the indices of the k closest embeddings in the vector database, for each input embedding
         """
         raise RuntimeError("This method should never be called.")
 
+    def get_closest_chunks_batch(self, keywords_list: List[str], k: int = 3) -> List[List[Chunk]]:
+        """
+        returns, for each keywords, the (at most) k chunks that contains pieces of text closest to them
+        """
+        return [self.get_closest_chunks(keywords, k) for keywords in keywords_list]
+
     def get_closest_chunks(self, keywords: str, k: int = 3) -> List[Chunk]:
         """
         returns the (at most) k chunks that contains pieces of text closest to the input_text
         """
-        if len(self.chunks) <= k: return list(self.chunks.values())
+        if self.nb_chunks() <= k: return [chunk for chunk in self.chunks if chunk is not None]
         # does a search in the index
         chunks = []
         # NOTE: B=0 means no penality to document length
@@ -89,33 +124,29 @@ class WhooshDatabase(Database):
                 chunks.append(chunk)
         return chunks
 
-    def remove_file(self, file_path:Path):
-        """Removes a file's content from the Database"""
-        file = self.files[file_path]
-        indices_to_remove = file.vector_database_indices
-        # remove file chunks from chunks
-        for index in indices_to_remove:
-            del self.chunks[index]
-        # remove all chunks associated with the given filepath
+    def remove_files(self, file_paths:List[Path]):
+        """Removes several files' content from the Database, using a single writer"""
+        if len(file_paths) == 0: return
         writer = self.index.writer()
-        writer.delete_by_term('filepath', str(file_path))
+        for file_path in file_paths:
+            indices_to_remove = self.files[file_path].vector_database_indices
+            # remove file chunks from chunks, freeing their indices
+            for index in indices_to_remove:
+                self.chunks[index] = None
+            self.free_indices.extend(indices_to_remove)
+            # remove all chunks associated with the given filepath
+            writer.delete_by_term('filepath', str(file_path))
+            # remove file from files
+            del self.files[file_path]
         writer.commit()
-        # remove file from files
-        del self.files[file_path]
 
-    def add_file(self, file_path:Path):
-        """Add a file's content to the database"""
-        # shortcut the function on ignored files
-        if self._is_ignored_file(file_path): return
+    def _add_chunks(self, file_path:Path, file_update_date:datetime, content_hash:str, chunks:List[Chunk]):
+        """Add a file's chunks to the database"""
         # open file in the database
-        file_update_date = datetime.fromtimestamp(file_path.stat().st_mtime)
-        file = File(creation_date=file_update_date)
-        # slice file into chunks small enough to fit several in the model's context size
-        chunks = chunk_file(file_path, self.documentation_folder, self.count_tokens_llm, self.max_tokens_per_chunk)
-        writer = self.index.writer()
-        for chunk in chunks:
-            # get current chunk index
-            chunk_index = self.current_id
+        file = File(creation_date=file_update_date, content_hash=content_hash)
+        chunks_indices = self._allocate_indices(len(chunks))
+        writer = self.index.writer() if (self.writer is None) else self.writer
+        for chunk_index, chunk in zip(chunks_indices, chunks):
             # gets the headlines from the file
             headlines = extract_markdown_headlines(chunk.content)
             # add chunk to the database
@@ -124,44 +155,58 @@ class WhooshDatabase(Database):
                 url=chunk.url,
                 headlines=headlines,
                 content=chunk.content)
-            self.current_id += 1
             # add index to file
             file.add_index(chunk_index)
             # register chunk at the sub chunk's index
             self.chunks[chunk_index] = chunk
-        writer.commit()
+        if self.writer is None: writer.commit()
         # add file to files
         self.files[file_path] = file
 
+    def add_files(self, files:List[Tuple[Path, datetime]], verbose=False):
+        """
+        Add several files' content to the database, given their paths and update dates.
+        Uses a single writer for all files, a multiprocess one (deferring segment merges to the save) for large batches.
+        """
+        if len(files) == 0: return
+        if len(files) >= MULTIPROCESS_WRITER_MIN_FILES:
+            nb_procs = max(1, min(MAX_CHUNKING_WORKERS, (os.cpu_count() or 1) // 2))
+            self.writer = self.index.writer(procs=nb_procs, limitmb=512, multisegment=True)
+        else:
+            # small batches are cheaper to write with a plain writer, relying on whoosh's default merging policy
+            self.writer = self.index.writer()
+        try:
+            super().add_files(files, verbose=verbose)
+            self.writer.commit()
+            self.has_new_segments = True
+        except:
+            self.writer.cancel()
+            raise
+        finally:
+            self.writer = None
+
     def exists(self):
         """returns True if the database already exists on disk"""
-        database_data_file = self.database_folder / 'whoosh_database.json'
-        return self.database_folder.exists() and database_data_file.exists() and exists_in(self.database_folder)
+        return super().exists() and exists_in(self.database_folder)
 
     def save(self):
         """ensures the database is saved"""
-        # first save the rest of the database, ensuring the folder exists
+        # saves the rest of the database, ensuring the folder exists
         super().save()
-        # saves the database data
-        with open(self.database_folder / 'whoosh_database.json', 'w') as f:
-            database_data = {'current_id': self.current_id}
-            json.dump(database_data, f)
-        # NOTE: we don't save the index as `writer.commit` already takes care of it
+        # merges the segments once there are too many of them (such as after a multiprocess write)
+        # NOTE: we don't otherwise save the index as `writer.commit` already takes care of it
+        if self.has_new_segments:
+            with self.index.reader() as reader:
+                nb_segments = len(reader.leaf_readers())
+            if nb_segments > MAX_SEGMENTS_BEFORE_OPTIMIZE:
+                self.index.optimize()
+            self.has_new_segments = False
 
     def load(self, update_database=True, verbose=False):
         """loads the database"""
-        if self.exists():
-            # load the index
-            self.index = open_dir(self.database_folder)
-            # load the database_data
-            with open(self.database_folder / 'whoosh_database.json', 'r') as f:
-                database_data = json.load(f)
-                self.current_id = int(database_data['current_id'])
-        else:
-            # insures that the saving folder exists
-            self.database_folder.mkdir(parents=True, exist_ok=True)
-            # creates a new index
-            self.index = create_in(self.database_folder, CHUNK_SCHEMA)
-            self.current_id = 0
+        # insures that the saving folder exists
+        self.database_folder.mkdir(parents=True, exist_ok=True)
+        # loads the index, creating it if needed
+        self.index = _open_index(str(self.database_folder))
         # loads the rest of the database and optionaly updates it
         super().load(update_database=update_database, verbose=verbose)
@@ -1,5 +1,6 @@
 from abc import ABC, abstractmethod
 from pathlib import Path
+from typing import List
 import numpy as np
 from ..tokenizer import Tokenizer
 
@@ -61,6 +62,36 @@ class Embedding(ABC):
                 return raw_embedding
             return raw_embedding / norm
 
+    def embed_batch(self, texts:List[str], is_query=False) -> np.ndarray:
+        """
+        Converts several texts into a (nb_texts, embedding_length) float32 matrix of embeddings.
+        """
+        if len(texts) == 0:
+            return np.empty((0, self.embedding_length), dtype=np.float32)
+        try:
+            texts = [((self.query_prefix + text) if is_query else (self.passage_prefix + text)) for text in texts]
+            raw_embeddings = self._embed_batch(texts, is_query)
+        except Exception as e:
+            print(f"An error occurred while embedding {len(texts)} texts: {str(e)}")
+            raise  # rethrow the exception after handling
+
+        # NOTE: this is a no-op on the (float32, contiguous) output of most models,
+        # which can then be passed to the vector database without further copies
+        embeddings = np.ascontiguousarray(raw_embeddings, dtype=np.float32).reshape((len(texts), self.embedding_length))
+        if not self.normalized:
+            # normalize the embeddings, row by row, in place
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            norms[norms == 0] = 1
+            embeddings /= norms
+        return embeddings
+
+    def _embed_batch(self, texts:List[str], is_query=False) -> np.ndarray:
+        """
+        Converts several texts into embeddings.
+        Defaults to embedding texts one at a time, models that support batching should overload it.
+        """
+        return np.stack([self._embed(text, is_query) for text in texts])
+
     @abstractmethod
     def _embed(self, text:str, is_query=False) -> np.ndarray:
         """
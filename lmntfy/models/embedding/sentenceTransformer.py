@@ -33,6 +33,12 @@ class SentenceTransformerEmbedding(Embedding):
         """
         return self.model.encode([text], convert_to_numpy=True, normalize_embeddings=self.normalized)[0]
 
+    def _embed_batch(self, texts, is_query=False):
+        """
+        SBERT specific batched embedding computation.
+        """
+        return self.model.encode(texts, convert_to_numpy=True, normalize_embeddings=self.normalized)
+
 #--------------------------------------------------------------------------------------------------
 # MODELS
 
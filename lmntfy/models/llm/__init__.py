@@ -10,19 +10,26 @@ class LanguageModel(ABC):
     Combines an engine and the corresponding chat tokenizer.
     """
     def __init__(self, models_folder:Path, name:str, use_system_prompt: bool, 
-                 chat_template:str=None, device:str='cuda',
+                 chat_template:str=None, device:str='cuda', context_size:int=None,
                  engineType=TransformerEngine, **engine_kwargs):
+        """
+        context_size can be used to cap the model's context size (defaults to the model's maximum)
+        NOTE: it is passed to the engine, such that it only reserves memory for the context we will use
+        """
         # names of the things
         self.name = name
         self.pretrained_model_name_or_path = str(models_folder / name)
         # loads the components of the model
-        self.engine: LLMEngine = engineType(self.pretrained_model_name_or_path, device=device, **engine_kwargs)
+        self.engine: LLMEngine = engineType(self.pretrained_model_name_or_path, device=device, context_size=context_size, **engine_kwargs)
         self.tokenizer = ChatTokenizer(self.pretrained_model_name_or_path, context_size=self.engine.context_size, 
                                        chat_template=chat_template, use_system_prompt=use_system_prompt)
         # parameters of the LLM
         self.context_size = self.engine.context_size
         self.upper_answer_size = self.tokenizer.upper_answer_size
         self.upper_question_size = self.tokenizer.upper_question_size
+        # maximum prompt sizes, leaving space for the model's output
+        self.max_answer_prompt_size = self.context_size - self.upper_answer_size
+        self.max_question_prompt_size = self.context_size - self.upper_question_size
         self.device = device
 
     def count_tokens(self, text:str) -> int:
@@ -41,7 +48,7 @@ class LanguageModel(ABC):
         """
         return self.tokenizer.apply_chat_template(messages, nb_tokens_max)
 
-    async def generate(self, prompt:str, stopwords:List[str]=[], strip_stopword:bool=True, verbose:bool=False) -> str:
+    async def generate(self, prompt:str, stopwords:List[str]=[], strip_stopword:bool=True, max_tokens:int=None, verbose:bool=False) -> str:
         """
         Query the model and get a response.
 
@@ -49,11 +56,12 @@ class LanguageModel(ABC):
             prompt (str): the text prompt
             stopwords (List[str]): the words on which to stop the generation, if any
             strip_stopword (bool): should we strip the stopword from our output (default to True)
+            max_tokens (int): maximum number of tokens to generate, if any (defaults to None, the context size being the limit)
             verbose (bool): should we print debug information? (defaults to False)
 
         Returns:
             str: The generated response from the model.
         """
-        return await self.engine.generate(prompt, stopwords, strip_stopword, verbose)
+        return await self.engine.generate(prompt, stopwords, strip_stopword, max_tokens, verbose)
 
 from .models import *
\ No newline at end of file
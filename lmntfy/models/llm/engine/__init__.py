@@ -11,7 +11,7 @@ class LLMEngine(ABC):
         self.device = device
 
     @abstractmethod
-    async def generate(self, prompt:str, stopwords:List[str]=[], strip_stopword:bool=True, verbose:bool=False) -> str:
+    async def generate(self, prompt:str, stopwords:List[str]=[], strip_stopword:bool=True, max_tokens:int=None, verbose:bool=False) -> str:
         """
         Query the model and get a response.
 
@@ -19,6 +19,7 @@ class LLMEngine(ABC):
             prompt (str): the text prompt
             stopwords (List[str]): the words on which to stop the generation, if any
             strip_stopword (bool): should we strip the stopword from our output (default to True)
+            max_tokens (int): maximum number of tokens to generate, if any (defaults to None, the context size being the limit)
             verbose (bool): should we print debug information? (defaults to False)
 
         Returns:
@@ -29,3 +30,4 @@ class LLMEngine(ABC):
 # imports the various engines
 from .transformer_engine import TransformerEngine
 from .vllm_engine import VllmEngine
+from .tokenizer_only_engine import TokenizerOnlyEngine
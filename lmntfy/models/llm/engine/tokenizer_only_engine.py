@@ -0,0 +1,20 @@
+from typing import List
+from transformers import AutoConfig
+from . import LLMEngine
+
+class TokenizerOnlyEngine(LLMEngine):
+    """
+    Engine that does not load the model's weights, only its configuration.
+    Useful when we only need the model's tokenizer and context size (such as when building the database).
+    """
+    def __init__(self, pretrained_model_name_or_path:str, device='cpu', context_size:int=None):
+        config = AutoConfig.from_pretrained(pretrained_model_name_or_path)
+        # initializes the rest of the engine
+        self.context_size = context_size or config.max_position_embeddings
+        super().__init__(pretrained_model_name_or_path, self.context_size, device)
+
+    async def generate(self, prompt:str, stopwords:List[str]=[], strip_stopword:bool=True, max_tokens:int=None, verbose:bool=False) -> str:
+        """
+        This engine cannot generate text.
+        """
+        raise RuntimeError("The TokenizerOnlyEngine does not load a model and thus cannot generate text, use another engine.")
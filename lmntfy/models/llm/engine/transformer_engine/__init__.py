@@ -12,16 +12,16 @@ class TransformerEngine(LLMEngine):
     """
     Hugginface's Transformer based engine.
     """
-    def __init__(self, pretrained_model_name_or_path:str, device='cuda', model_kwargs:dict=dict()):
+    def __init__(self, pretrained_model_name_or_path:str, device='cuda', model_kwargs:dict=dict(), context_size:int=None):
         self.tokenizer = AutoTokenizer.from_pretrained(pretrained_model_name_or_path)
         self.model = AutoModelForCausalLM.from_pretrained(pretrained_model_name_or_path, 
                                                           device_map=device, torch_dtype=bfloat16,
                                                           **model_kwargs)
          # initializes the rest of the engine
-        self.context_size = self.model.config.max_position_embeddings
+        self.context_size = context_size or self.model.config.max_position_embeddings
         super().__init__(pretrained_model_name_or_path, self.context_size, device)
 
-    async def generate(self, prompt:str, stopwords:List[str]=[], strip_stopword:bool=True, verbose:bool=False) -> str:
+    async def generate(self, prompt:str, stopwords:List[str]=[], strip_stopword:bool=True, max_tokens:int=None, verbose:bool=False) -> str:
         """
         Query the model and get a response.
 
@@ -29,6 +29,7 @@ class TransformerEngine(LLMEngine):
             prompt (str): the text prompt
             stopwords (List[str]): the words on which to stop the generation, if any
             strip_stopword (bool): should we strip the stopword from our output (default to True)
+            max_tokens (int): maximum number of tokens to generate, if any (defaults to None, the context size being the limit)
             verbose (bool): should we print debug information? (defaults to False)
 
         Returns:
@@ -48,10 +49,12 @@ class TransformerEngine(LLMEngine):
         # NOTE: we ensure that only one request is currently running on the GPU
         #       meanwhile, other CPU tasks can be done
         #       -> we could cut the code and have this engine be actualy synchronous (but this would be bad)
+        # bounds the generation by the context size and, optionally, a maximum number of new tokens
+        length_kwargs = dict(max_length=self.context_size) if (max_tokens is None) else dict(max_new_tokens=min(max_tokens, self.context_size - inputs_tokens.size(-1)))
         async with transformer_gpu_lock:
             output_tokens = await asyncio.to_thread(self.model.generate, 
                                                     inputs_tokens, 
-                                                    max_length=self.context_size, 
+                                                    **length_kwargs, 
                                                     pad_token_id=self.tokenizer.eos_token_id,
                                                     stopping_criteria=[stopping_criteria])
 
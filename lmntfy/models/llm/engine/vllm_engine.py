@@ -24,21 +24,34 @@ class VllmEngine(LLMEngine):
     """
     vLLM-based engine
     """
-    def __init__(self, pretrained_model_name_or_path:str, device='cuda', nb_gpus=1):
+    def __init__(self, pretrained_model_name_or_path:str, device='cuda', nb_gpus=1,
+                 context_size:int=None, gpu_memory_utilization:float=0.9, kv_cache_dtype:str='auto',
+                 enable_prefix_caching:bool=True):
+        """
+        context_size caps the model's context (defaults to the model's maximum)
+        gpu_memory_utilization is the fraction of the GPU memory vLLM can use for the weights and paged KV cache
+        kv_cache_dtype can be set to 'fp8_e5m2' (or 'fp8' on recent GPUs) to halve the KV cache's memory footprint and bandwidth
+        enable_prefix_caching lets successive generations on a growing prompt (answer, then each reference)
+        reuse the KV cache of their common prefix instead of reprocessing the full prompt
+        NOTE: vLLM refuses to use prefix caching with sliding window models
+        """
         # ensuring the device is a GPU
         if (device == 'cpu'):
             device = 'cuda'
             print("WARNING: switching device to GPU as VLLM currently only supports GPU")
         # load and starts the engine
         if (nb_gpus > 1): print(f"Setting up vLLM on {nb_gpus} GPUs, this might take some time.")
+        # NOTE: max_model_len has to be set here as vLLM sizes its KV cache from it
         engine_args = AsyncEngineArgs(model=pretrained_model_name_or_path, tensor_parallel_size=nb_gpus, device=device,
+                                      max_model_len=context_size, gpu_memory_utilization=gpu_memory_utilization,
+                                      enable_prefix_caching=enable_prefix_caching, kv_cache_dtype=kv_cache_dtype,
                                       disable_log_requests=True, disable_log_stats=False)
         self.llm_engine = AsyncLLMEngine.from_engine_args(engine_args, start_engine_loop=True, usage_context=UsageContext.API_SERVER)
         # initializes the rest of the engine
         self.context_size = self.llm_engine.engine.model_config.max_model_len
         super().__init__(pretrained_model_name_or_path, self.context_size, device)
 
-    async def generate(self, prompt:str, stopwords:List[str]=[], strip_stopword:bool=True, verbose:bool=False) -> str:
+    async def generate(self, prompt:str, stopwords:List[str]=[], strip_stopword:bool=True, max_tokens:int=None, verbose:bool=False) -> str:
         """
         Query the model and get a response.
 
@@ -46,13 +59,14 @@ class VllmEngine(LLMEngine):
             prompt (str): the text prompt
             stopwords (List[str]): the words on which to stop the generation, if any
             strip_stopword (bool): should we strip the stopword from our output (default to True)
+            max_tokens (int): maximum number of tokens to generate, if any (defaults to None, the context size being the limit)
             verbose (bool): should we print debug information? (defaults to False)
 
         Returns:
             str: The generated response from the model.
         """
         # defines the sampling parameters with our stopping criteria
-        sampling_params = SamplingParams(temperature=0, max_tokens=None, 
+        sampling_params = SamplingParams(temperature=0, max_tokens=max_tokens, 
                                          stop=stopwords, include_stop_str_in_output=not strip_stopword)
 
         # generate an async iterator
@@ -76,7 +76,6 @@ class Vicuna(LanguageModel):
                  use_system_prompt:bool=True, chat_template:str=None, 
                  device:str='cuda', engineType=VllmEngine):
         # TODO need VICUNA_CHAT_TEMPLATE?
+        # NOTE: fixes a too large context otherwise gotten
         super().__init__(models_folder=models_folder, name=name, use_system_prompt=use_system_prompt, 
-                         chat_template=chat_template, device=device, engineType=engineType)
-        # fixes a too large context otherwise gotten
-        self.context_size = 4096
+                         chat_template=chat_template, device=device, context_size=4096, engineType=engineType)
@@ -2,6 +2,13 @@ from pathlib import Path
 from .. import LanguageModel
 from ..engine import VllmEngine
 
+def sliding_window_engine_kwargs(engineType) -> dict:
+    """
+    engine arguments for models using sliding window attention (Mistral v0.1 based models)
+    NOTE: vLLM refuses to start such models with prefix caching enabled
+    """
+    return dict(enable_prefix_caching=False) if (engineType is VllmEngine) else dict()
+
 class Mistral(LanguageModel):
     def __init__(self, models_folder:Path, name:str='Mistral-7B-Instruct-v0.2',
                  use_system_prompt:bool=False, chat_template:str=None, 
@@ -14,33 +21,34 @@ class Zephyr(LanguageModel):
                  use_system_prompt:bool=False, chat_template:str=None, 
                  device:str='cuda', engineType=VllmEngine):
         super().__init__(models_folder=models_folder, name=name, use_system_prompt=use_system_prompt, 
-                         chat_template=chat_template, device=device, engineType=engineType)
+                         chat_template=chat_template, device=device, engineType=engineType,
+                         **sliding_window_engine_kwargs(engineType))
 
 class OpenChat(LanguageModel):
     def __init__(self, models_folder:Path, name:str='openchat-3.5-0106',
                  use_system_prompt:bool=False, chat_template:str=None, 
                  device:str='cuda', engineType=VllmEngine):
         super().__init__(models_folder=models_folder, name=name, use_system_prompt=use_system_prompt, 
-                         chat_template=chat_template, device=device, engineType=engineType)
+                         chat_template=chat_template, device=device, engineType=engineType,
+                         **sliding_window_engine_kwargs(engineType))
 
 class Snorkel(LanguageModel):
     def __init__(self, models_folder:Path, name:str='Snorkel-Mistral-PairRM-DPO',
                  use_system_prompt:bool=False, chat_template:str=None, 
                  device:str='cuda', engineType=VllmEngine):
+        # NOTE: context size needed as the model's maximum value is too large for the tokenizer, causing nonsense answers
         super().__init__(models_folder=models_folder, name=name, use_system_prompt=use_system_prompt, 
-                         chat_template=chat_template, device=device, engineType=engineType)
-        # NOTE: needed as the model's maximum value is too large for the tokenizer, causing nonsense answers
-        self.context_size = 2048
+                         chat_template=chat_template, device=device, context_size=2048, engineType=engineType)
 
 class Starling(LanguageModel):
     def __init__(self, models_folder:Path, name:str='Starling-LM-7B-alpha',
                  use_system_prompt:bool=False, chat_template:str=None, 
                  device:str='cuda', engineType=VllmEngine):
-        super().__init__(models_folder=models_folder, name=name, use_system_prompt=use_system_prompt, 
-                         chat_template=chat_template, device=device, engineType=engineType)
-        # NOTE: needed as 32k context segfaults
+        # NOTE: context size needed as 32k context segfaults
         # see: https://huggingface.co/berkeley-nest/Starling-LM-7B-alpha/discussions/25
-        self.context_size = 8*1024
+        super().__init__(models_folder=models_folder, name=name, use_system_prompt=use_system_prompt, 
+                         chat_template=chat_template, device=device, context_size=8*1024, engineType=engineType,
+                         **sliding_window_engine_kwargs(engineType))
 
 class StarlingCode(Starling):
     """variant of the model finetuned for code generation"""
@@ -4,9 +4,12 @@ from ..engine import VllmEngine
 
 class Qwen(LanguageModel):
     def __init__(self, models_folder:Path, name:str='Qwen1.5-14B-Chat',
-                 use_system_prompt:bool=False, chat_template:str=None, 
-                 device:str='cuda', engineType=VllmEngine):
-        super().__init__(models_folder=models_folder, name=name, use_system_prompt=use_system_prompt, 
-                         chat_template=chat_template, device=device, engineType=engineType)
-        # NOTE: needed as the full 32k context overflows the GPU memory
-        self.context_size = 8*1024
\ No newline at end of file
+                 use_system_prompt:bool=False, chat_template:str=None,
+                 device:str='cuda', engineType=VllmEngine, **engine_kwargs):
+        # NOTE: context size needed as the full 32k context overflows the GPU memory
+        #       the context size does not depend on the engine as the database's chunk size is derived from it
+        #       an 8 bits KV cache (`kv_cache_dtype='fp8_e5m2'` with vLLM) can be passed through engine_kwargs
+        #       but has not been validated against answer quality (nor together with prefix caching)
+        super().__init__(models_folder=models_folder, name=name, use_system_prompt=use_system_prompt,
+                         chat_template=chat_template, device=device, context_size=8*1024, engineType=engineType,
+                         **engine_kwargs)
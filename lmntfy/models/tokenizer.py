@@ -1,11 +1,21 @@
 from abc import ABC
-from copy import copy
+from functools import lru_cache
 from typing import List, Dict
 from transformers import AutoTokenizer, LlamaTokenizerFast, Qwen2TokenizerFast, PreTrainedTokenizerFast
 
 #--------------------------------------------------------------------------------------------------
 # GENERALIST
 
+@lru_cache(maxsize=1024)
+def _count_tokens(tokenizer, text:str) -> int:
+    """
+    Counts the number of tokens in a given string.
+    NOTE: memoized as system prompts and documentation chunks are counted again on every conversation turn
+          (defined at the module level to keep tokenizers picklable)
+    """
+    # NOTE: no need to build a tensor to get a length
+    return len(tokenizer.encode(text))
+
 class Tokenizer(ABC):
     """
     Encapsulates a model's tokenizer and the operations we need from it:
@@ -21,9 +31,15 @@ class Tokenizer(ABC):
         """
         Counts the number of tokens in a given string.
         """
-        tokens = self.tokenizer.encode(text, return_tensors='pt')
-        token_number = tokens.size(-1)
-        return token_number
+        return _count_tokens(self.tokenizer, text)
+
+    def count_tokens_batch(self, texts:List[str]) -> List[int]:
+        """
+        Counts the number of tokens in each of the given strings, in a single call to the tokenizer.
+        NOTE: does not count special tokens, as those strings are meant to be inserted into a larger prompt
+        """
+        if len(texts) == 0: return []
+        return self.tokenizer(texts, add_special_tokens=False, return_length=True)['length']
 
 #--------------------------------------------------------------------------------------------------
 # CHAT
@@ -91,59 +107,40 @@ class ChatTokenizer(Tokenizer):
         if (len(messages) < 1) or (messages[0]['role'] != "system"):
             # NOTE: no starting system message, we assume that this moel does not use system messages
             return messages
-        else:
-            system_message = copy(messages[0])
-            messages = messages[1:]
 
-        # accumulate system messages
-        nonsystem_messages = []
-        for message in messages:
+        # accumulate system messages, and ensure alternance of user-assistant messages in non-system messages
+        # NOTE: the system contents are joined once at the end rather than concatenated one message at a time
+        system_contents = [messages[0]['content']]
+        result = [None] # placeholder for the system message
+        next_is_user = True
+        for i in range(1, len(messages)):
+            message = messages[i]
             if (message['role'] == "system"):
                 # add content to the system message
-                system_message['content'] += message['content']
-            else:
+                system_contents.append(message['content'])
+            elif (message['role'] == 'user') == next_is_user:
                 # add message to result
-                nonsystem_messages.append(message)
-
-        # ensure alternance of user-assistant messages in non-system messages
-        result = [system_message]
-        next_is_user = True
-        for message in nonsystem_messages:
-            is_user = (message['role'] == 'user')
-            if (next_is_user and is_user) or ((not next_is_user) and (not is_user)):
                 result.append(message)
                 next_is_user = not next_is_user
+        result[0] = {**messages[0], 'content': ''.join(system_contents)}
         return result
 
-    def _drop_lowest_priority_message(self, messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    def _lowest_priority_message_index(self, messages: List[Dict[str, str]]) -> int | None:
         """
-        Finds the message with the lowest relevancy score and drops it from the conversation.
+        Finds the index of the message with the lowest relevancy score.
         If no message can be cut, returns None.
         """
-        # Find the index of the least relevant message, if any
         least_relevant_index = None
         least_relevancy = float('inf')
         for i, message in enumerate(messages):
             if ('relevancy' in message) and (message['relevancy'] < least_relevancy):
                 least_relevancy = message['relevancy']
                 least_relevant_index = i
+        return least_relevant_index
 
-        # returns
-        if least_relevant_index is None:
-            # no message can be cut, return None
-            return None
-        else:
-            # pop lowest relevancy message
-            messages.pop(least_relevant_index)
-            return messages
-
-    def apply_chat_template(self, messages: List[Dict[str, str]], nb_tokens_max:int=None) -> str:
+    def _apply_chat_template(self, messages: List[Dict[str, str]]) -> str:
         """
-        Takes a list of messages and applies the model's chat template.
-
-        NOTE:
-        - drops optional messages until the result fits in the given size
-        - merge all systems messages into the first message
+        Applies the model's chat template to a list of messages, without any size consideration.
         """
         # merge system messages (in case there is more than one)
         merged_messages = self._clean_messages(messages)
@@ -160,15 +157,63 @@ class ChatTokenizer(Tokenizer):
 
         # turns the conversation into a single string
         try:
-            output_string = self.tokenizer.apply_chat_template(merged_messages, add_generation_prompt=True, tokenize=False)
+            return self.tokenizer.apply_chat_template(merged_messages, add_generation_prompt=True, tokenize=False)
         except Exception as e:
             raise RuntimeError(f"Failed to apply chat templates with error '{e}'. Roles are: {[m['role'] for m in merged_messages]}") from e
 
-        # drop optional messages if needed
-        if (nb_tokens_max is not None) and (self.count_tokens(output_string) > nb_tokens_max):
-            shorten_messages = self._drop_lowest_priority_message(messages)
-            if shorten_messages is not None:
-                # if we could drop a message
-                return self.apply_chat_template(shorten_messages, nb_tokens_max)
-            
-        return output_string
\ No newline at end of file
+    def _count_prompt_tokens(self, prompt:str) -> int:
+        """
+        Counts the number of tokens in a prompt produced by the chat template.
+        NOTE: the template already contains the special tokens, and prompts are not memoized as they are rarely seen twice
+        """
+        return len(self.tokenizer.encode(prompt, add_special_tokens=False))
+
+    def apply_chat_template(self, messages: List[Dict[str, str]], nb_tokens_max:int=None) -> str:
+        """
+        Takes a list of messages and applies the model's chat template.
+
+        NOTE:
+        - drops optional messages until the result fits in the given size
+        - merge all systems messages into the first message
+        """
+        output_string = self._apply_chat_template(messages)
+        if nb_tokens_max is None: return output_string
+        nb_tokens = self._count_prompt_tokens(output_string)
+        if nb_tokens <= nb_tokens_max: return output_string
+
+        # counts the tokens of all messages in one batch
+        # the rest of the prompt (role headers, end of turn tokens, etc) is spread evenly over the messages
+        message_sizes = self.count_tokens_batch([message['content'] for message in messages])
+        message_overhead = (nb_tokens - sum(message_sizes)) / len(messages)
+
+        # drop optional messages until we fit
+        # NOTE: we work on a copy, leaving the caller's conversation untouched
+        messages = list(messages)
+        dropped_messages = list() # (index, message) of the dropped messages, in the order they were dropped
+        estimated_nb_tokens = nb_tokens
+        while nb_tokens > nb_tokens_max:
+            # drops messages until the estimated size fits, without rebuilding the prompt
+            nb_dropped_messages = 0
+            while estimated_nb_tokens > nb_tokens_max:
+                least_relevant_index = self._lowest_priority_message_index(messages)
+                if least_relevant_index is None: break
+                dropped_messages.append((least_relevant_index, messages.pop(least_relevant_index)))
+                estimated_nb_tokens -= message_sizes.pop(least_relevant_index) + message_overhead
+                nb_dropped_messages += 1
+            # stops if no message could be dropped
+            if nb_dropped_messages == 0: return output_string
+            # checks the actual size of the prompt
+            # NOTE: the estimate can be off (dropping a message can also drop a neighbour breaking the user/assistant alternance)
+            output_string = self._apply_chat_template(messages)
+            nb_tokens = self._count_prompt_tokens(output_string)
+            estimated_nb_tokens = nb_tokens
+
+        # the estimate might have made us drop too many messages
+        # puts back the last dropped messages for as long as the prompt still fits
+        while len(dropped_messages) > 0:
+            index, message = dropped_messages.pop()
+            messages.insert(index, message)
+            candidate_string = self._apply_chat_template(messages)
+            if self._count_prompt_tokens(candidate_string) > nb_tokens_max: break
+            output_string = candidate_string
+        return output_string
@@ -31,10 +31,11 @@ class QuestionAnswerer:
         formatted_discussion = [{**message, 'relevancy': i} for (i,message) in enumerate(previous_messages)]
         messages = [system_message] + formatted_discussion
         # builds the base prompt
-        prompt = self.llm.apply_chat_template(messages, nb_tokens_max=self.llm.context_size-self.llm.upper_question_size)
+        prompt = self.llm.apply_chat_template(messages, nb_tokens_max=self.llm.max_question_prompt_size)
         # prime the model to extract the question
         prompt_question_extraction = prompt + 'If I understand you clearly, your question is: "'
-        question = await self.llm.generate(prompt_question_extraction, stopwords=['"'], verbose=verbose)
+        # NOTE: the question is expected on a single line and bounded in size, which caps generation time if the model does not close the quote
+        question = await self.llm.generate(prompt_question_extraction, stopwords=['"', '\n'], max_tokens=self.llm.upper_question_size, verbose=verbose)
         return question
 
     async def _add_references(self, original_prompt: str, chunks: List[Chunk], verbose: bool = False) -> str:
@@ -98,7 +99,7 @@ class QuestionAnswerer:
         messages = [system_message] + chunks_messages + discussion_messages
 
         # turns the messages into a prompt
-        prompt = self.llm.apply_chat_template(messages, nb_tokens_max=self.llm.context_size-self.llm.upper_answer_size)
+        prompt = self.llm.apply_chat_template(messages, nb_tokens_max=self.llm.max_answer_prompt_size)
 
         # generates an answer, stopping at the reference section
         reference_section_titles = ["References:", "**References**:", "Reference(s):", "Sources:", "Ressources:", "Source URL:", "Source URLs:"]
@@ -5,6 +5,9 @@ from ..database.document_loader import Chunk
 # references to be returned in the absence of further information
 DEFAULT_REFERENCES = ["https://docs.nersc.gov/", "https://www.nersc.gov/users/getting-help/online-help-desk/"]
 
+# matches markdown references (` * <url>`), capturing the url
+REFERENCE_PATTERN = re.compile(r"\* \<([^\>]*?)\>")
+
 def stem_url(url: str) -> str:
     """
     Takes a URL and cuts it at the latest '#' if possible.
@@ -42,8 +45,7 @@ def validate_references(urls:List[str], chunks:List[Chunk], prompt:str, stem_bef
     # urls of the chunks
     chunk_urls = {stemmer(chunk.url) for chunk in chunks}
     # urls referenced in the conversation so far
-    reference_pattern = r"\* \<([^\>]*?)\>"
-    prompt_urls = {stemmer(url) for url in re.findall(reference_pattern, prompt)}
+    prompt_urls = {stemmer(url) for url in REFERENCE_PATTERN.findall(prompt)}
     # set of urls accepted
     accepted_urls = chunk_urls | prompt_urls
 
@@ -4,6 +4,7 @@ This script updates the database then stops.
 import lmntfy
 import argparse
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -20,12 +21,17 @@ def main():
     database_folder = args.database_folder
     models_folder = args.models_folder
 
-    # load the database and updates it if needed
-    llm = lmntfy.models.llm.Default(models_folder,
-                                    # keep the model on CPU as we will not need to draw upon it
-                                    device='cpu', engineType=lmntfy.models.llm.engine.TransformerEngine)
-    embedder = lmntfy.models.embedding.Default(models_folder)
+    # load the models
+    # NOTE: the embedder is loaded on a background thread while the llm loads (both are mostly spent in I/O and native code)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        embedder_future = executor.submit(lmntfy.models.embedding.Default, models_folder)
+        llm = lmntfy.models.llm.Default(models_folder,
+                                        # only load the tokenizer and context size as we will not draw upon the model
+                                        device='cpu', engineType=lmntfy.models.llm.engine.TokenizerOnlyEngine)
+        embedder = embedder_future.result()
     reranker = lmntfy.models.reranker.NoReranker(models_folder)
+
+    # load the database and updates it if needed
     database = lmntfy.database.Default(docs_folder, database_folder, llm, embedder, reranker, update_database=True)
     print("Done!")
 